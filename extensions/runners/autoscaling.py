@@ -1,74 +1,103 @@
 """Runner that implements autoaccepting autoscaled minions.
 
-Not necessarily AWS specific. Note that this runner must not be used
-concurrently as sqlite doesn't really like that.
+Not necessarily AWS specific. Bookkeeping is delegated to
+autoscale_registry_daemon.py, which must be listening on `socket_location`. See
+the `systemd` directory for how to run it.
 """
+import contextlib
 import salt.client
+import socket
 import subprocess
 
+try:
+  import boto3
+  HAS_BOTO3 = True
+except ImportError:
+  HAS_BOTO3 = False
+
 
 # Constants
 
-DEFAULT_DATABASE_LOCATION = '/var/tmp/salt-autoscaling.db'
-DEFAULT_REGISTRY_SCRIPT = '/PLACEHOLDER_PATH_TO_REACTORS/autoscaling/autoscale_registry.py'
+DEFAULT_SOCKET_LOCATION = '/var/run/salt-autoscaling.sock'
+
+# Seconds to wait for the registry daemon. Longer than its default database
+# lock timeout.
+REGISTRY_TIMEOUT = 60
+
+
+# Globals
+
+# EC2 client, created on first use so its connection pool is reused across
+# events.
+_ec2 = None
 
 
 # Functions
 
 
-def _registry_call(database_location, registry_script):
-  return ['python', registry_script, '--database-file', database_location]
+def _registry_call(socket_location, *command):
+  """
+  Run an autoscale_registry.py subcommand through autoscale_registry_daemon.py.
+
+  Returns the exit status of the subcommand.
+  """
+  # Minion ids are chosen by the minions themselves. Never let one smuggle in
+  # a second argument or request.
+  for part in command:
+    if '\t' in part or '\n' in part:
+      raise ValueError(f"Invalid registry argument: {part!r}")
+
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  with contextlib.closing(sock):
+    sock.settimeout(REGISTRY_TIMEOUT)
+    sock.connect(socket_location)
+    sock.sendall(('\t'.join(command) + '\n').encode())
+    sock.shutdown(socket.SHUT_WR)
+    status = sock.recv(1)
+  return int(status) if status else 1
 
 
 def _accept_minion(name):
   wheel = salt.wheel.Wheel(__opts__)
   wheel.call_func('key.accept', match=name)
-  print "Accepted minion:", name
+  print(f"Accepted minion: {name}")
 
 
-def _key_submitted_and_autoscaled(registry_call, name):
-  return subprocess.call(registry_call + ['check', name]) == 0
+def _key_submitted_and_autoscaled(socket_location, name):
+  return _registry_call(socket_location, 'check', name) == 0
 
 
-def minion_connected(name, database_location=DEFAULT_DATABASE_LOCATION,
-    registry_script=DEFAULT_REGISTRY_SCRIPT):
+def minion_connected(name, socket_location=DEFAULT_SOCKET_LOCATION):
   """
   Notify that a potential autoscaling minion has connected.
   
   If a minion with the same name has been registered through
   `register_autoscaled_instance` function, the minion will automatically be accepted.
   """
-  registry_call = _registry_call(database_location, registry_script)
-  subprocess.call(registry_call + ['new-minion', name])
-  if _key_submitted_and_autoscaled(registry_call, name):
+  if _registry_call(socket_location, 'new-minion-and-check', name) == 0:
     _accept_minion(name)
 
 
 def register_autoscaled_instance(name,
-    database_location=DEFAULT_DATABASE_LOCATION,
-    registry_script=DEFAULT_REGISTRY_SCRIPT):
+    socket_location=DEFAULT_SOCKET_LOCATION):
   """
   Notify that an autoscaling instance has started and we should accept it.
   
   If the minion has previously been submitted to `minion_connected`, the minion
   will be accepted immediately.
   """
-  registry_call = _registry_call(database_location, registry_script)
-  subprocess.call(registry_call + ['new-instance', name])
-  if _key_submitted_and_autoscaled(registry_call, name):
+  if _registry_call(socket_location, 'new-instance-and-check', name) == 0:
     _accept_minion(name)
 
 
 def highstate_accepted_minion(name,
-    database_location=DEFAULT_DATABASE_LOCATION,
-    registry_script=DEFAULT_REGISTRY_SCRIPT):
+    socket_location=DEFAULT_SOCKET_LOCATION):
   """
   Highstate a previously accepted minion.
 
   Highstating is done asynchronously to not block the reactor.
   """
-  registry_call = _registry_call(database_location, registry_script)
-  if _key_submitted_and_autoscaled(registry_call, name):
+  if _key_submitted_and_autoscaled(socket_location, name):
     client = salt.client.LocalClient(__opts__['conf_file'])
     client.cmd_async(name, 'state.highstate')
 
@@ -76,10 +105,16 @@ def highstate_accepted_minion(name,
 def tag_aws_instance(resourceid, name):
   # Assumes either the runner host has an EC2 role assigned to it, or it has
   # AWS credentials in its user's home directory.
-  subprocess.call(['aws', 'ec2', 'create-tags', '--resources', resourceid,
-    '--tags', 'Key=Name,Value={0}'.format(name)])
+  if not HAS_BOTO3:
+    subprocess.call(['aws', 'ec2', 'create-tags', '--resources', resourceid,
+      '--tags', f'Key=Name,Value={name}'])
+    return
+
+  global _ec2
+  if _ec2 is None:
+    _ec2 = boto3.client('ec2')
+  _ec2.create_tags(Resources=[resourceid], Tags=[{'Key': 'Name', 'Value': name}])
 
 
-def cleanup():
-  registry_call = _registry_call(database_location, registry_script)
-  subprocess.call(registry_call + ['purge', '60', 'days'])
+def cleanup(socket_location=DEFAULT_SOCKET_LOCATION):
+  _registry_call(socket_location, 'purge', '60', 'days')
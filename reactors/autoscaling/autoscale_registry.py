@@ -1,3 +1,4 @@
+#!/usr/bin/env python3
 """A small CLI application for tracking autoscaling of minions.
 
 For a minion to be auto-accepted by a Salt master there are two separate events that needs to happen:
@@ -8,211 +9,180 @@ For a minion to be auto-accepted by a Salt master there are two separate events
 
 When both requirements are satisfied (check), a minion can be accepted. This
 script keeps a small sqlite database of the auto-scaling states minions are in.
+The same subcommands are served by autoscale_registry_daemon.py.
 
 TODO: Add a pruning command to eventually delete old data.
 """
 import argparse
-import collections
 import contextlib
 import datetime
-import os
 import sqlite3
 import sys
 import time
 
 
-def pid_is_running(pid):
-  """Check For the existence of a unix pid. """
-  try:
-    os.kill(pid, 0)
-  except OSError:
-    return False
-  else: return True
-
-
-class InterprocessLock:
-  def __init__(self, path, timeout):
-    self._path = path
-    self._timeout = timeout   # seconds
-
-  def _try_lock_once(self):
-    try:
-      f = os.open(self._path, os.O_CREAT | os.O_EXCL | os.O_WRONLY | os.O_TRUNC)
-      try:
-        os.write(f, "{0}".format(os.getpid()))
-      finally:
-        os.close(f)
-      return True
-    except OSError, e:
-      return False
-
-  def _lock_owner_alive(self):
-    try:
-      f = open(self._path)
-      with contextlib.closing(f):
-        return pid_is_running(int(f.read()))
-    except ValueError:
-      return False
-    except IOError:
-      return False
-
-  def _invalidate_lock(self):
-    os.unlink(self._path)
-
-  def _try_lock_with_retry(self):
-    for _ in range(self._timeout):
-      if self._try_lock_once():
-        return True
-      elif not self._lock_owner_alive():
-        self._invalidate_lock()
-      else:
-        time.sleep(1)
-    return False
-
-  def try_lock(self):
-    self._locked = self._try_lock_with_retry()
-    return self._locked
-
-  def close(self):
-    if self._locked:
-      self._invalidate_lock()
-
-
 @contextlib.contextmanager
-def sqlite_connection(path):
-  conn = sqlite3.connect(path)
-  yield conn
-  conn.close()
+def sqlite_connection(path, timeout):
+  # Transactions are managed explicitly through `transaction` below.
+  # `timeout` is SQLite's busy timeout and applies from the first statement.
+  conn = sqlite3.connect(path, timeout=timeout, isolation_level=None,
+                         cached_statements=256)
+  if path != ':memory:':
+    # WAL lets readers run concurrently with the (SQLite-serialized) writer,
+    # and with synchronous=NORMAL only checkpoints fsync, not every commit. A
+    # power loss may roll back the most recent commits but cannot corrupt the
+    # database. The busy timeout makes concurrent invocations wait for each
+    # other instead of failing.
+    # auto_vacuum only takes effect if set before the database is switched to
+    # WAL and its first table is created.
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")
+    conn.execute("PRAGMA mmap_size=268435456")
+  try:
+    yield conn
+    conn.execute("PRAGMA optimize")
+  finally:
+    conn.close()
 
 
 @contextlib.contextmanager
-def sqlite_cursor(conn):
-  c = conn.cursor()
-  yield c
-  c.close()
+def transaction(conn):
+  conn.execute("BEGIN IMMEDIATE")
+  try:
+    yield
+    conn.execute("COMMIT")
+  finally:
+    # Covers both a failed body and a failed COMMIT. SQLite may already have
+    # rolled back on its own, in which case there is nothing left to undo.
+    if conn.in_transaction:
+      conn.execute("ROLLBACK")
 
 
-Record = collections.namedtuple('Record', ('instanceid', 'instancetimestamp', 'miniontimestamp'))
+# Stored in `PRAGMA user_version` once the schema below has been created.
+SCHEMA_VERSION = 2
 
 
 def create_table_if_not_exist(conn):
-  with sqlite_cursor(conn) as c:
-    c.execute("CREATE TABLE IF NOT EXISTS instances (instanceid TEXT CONSTRAINT instanceid PRIMARY KEY ON CONFLICT REPLACE, instancetimestamp NUMERIC, miniontimestamp NUMERIC)")
-
-
-def read_record(conn, instanceid):
-  with sqlite_cursor(conn) as c:
-    c.execute("SELECT instanceid, instancetimestamp, miniontimestamp FROM instances WHERE instanceid=?", (instanceid,))
-    for row in c:
-      return Record(*row)
-    else:
-      return None
-
-
-def write_record(conn, record):
-  with sqlite_cursor(conn) as c:
-    c.execute("INSERT INTO instances (instanceid, instancetimestamp, miniontimestamp) VALUES(?, ?, ?)", record)
-
+  if conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION:
+    return
+  with transaction(conn):
+    # Re-read under the write lock in case a concurrent invocation just
+    # upgraded the database.
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    conn.execute("CREATE TABLE IF NOT EXISTS instances (instanceid TEXT PRIMARY KEY, instancetimestamp INTEGER, miniontimestamp INTEGER)")
+    if version < 2:
+      # Timestamps used to be stored as float seconds.
+      conn.execute("UPDATE instances"
+                   " SET instancetimestamp=CAST(instancetimestamp * 1000000000 AS INTEGER),"
+                   " miniontimestamp=CAST(miniontimestamp * 1000000000 AS INTEGER)")
+    # Partial indexes covering the pending listings in `check`. Looking up a
+    # single instance is already served by the primary key.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_pending_minion ON instances (instanceid)"
+                 " WHERE miniontimestamp IS NULL AND instancetimestamp IS NOT NULL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_pending_instance ON instances (instanceid)"
+                 " WHERE miniontimestamp IS NOT NULL AND instancetimestamp IS NULL")
+    conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+
+def register_instances(conn, instances):
+  now = time.time_ns()
+  conn.executemany("INSERT INTO instances (instanceid, instancetimestamp) VALUES(?, ?)"
+                   " ON CONFLICT(instanceid) DO UPDATE SET instancetimestamp=excluded.instancetimestamp",
+                   [(instance, now) for instance in instances])
+
+
+def register_minions(conn, minions):
+  now = time.time_ns()
+  conn.executemany("INSERT INTO instances (instanceid, miniontimestamp) VALUES(?, ?)"
+                   " ON CONFLICT(instanceid) DO UPDATE SET miniontimestamp=excluded.miniontimestamp",
+                   [(minion, now) for minion in minions])
+
+
+def new_instance(conn, args):
+  with transaction(conn):
+    register_instances(conn, args.instances)
+  return 0
 
-def new_instance(args):
-  lock = InterprocessLock("{0}.lock".format(args.database_file), args.lock_timeout)
-  if not lock.try_lock():
-    print "Could not take lock."
-    return 1
 
-  with contextlib.closing(lock), sqlite_connection(args.database_file) as conn:
-    create_table_if_not_exist(conn)
-    for instance in args.instances:
-      record = read_record(conn, instance)
-      if record is None:
-        record = Record(instanceid=instance, instancetimestamp=time.time(), miniontimestamp=None)
-      else:
-        record = record._replace(instancetimestamp=time.time())
-      write_record(conn, record)
-    conn.commit()
+def new_minion(conn, args):
+  with transaction(conn):
+    register_minions(conn, args.minions)
   return 0
 
 
-def new_minion(args):
-  lock = InterprocessLock("{0}.lock".format(args.database_file), args.lock_timeout)
-  if not lock.try_lock():
-    print "Could not take lock."
-    return 1
+def new_instance_and_check(conn, args):
+  with transaction(conn):
+    register_instances(conn, [args.instance])
+    return check(conn, args)
 
-  with contextlib.closing(lock), sqlite_connection(args.database_file) as conn:
-    create_table_if_not_exist(conn)
-    for minion in args.minions:
-      record = read_record(conn, minion)
-      if record is None:
-        record = Record(instanceid=minion, instancetimestamp=None, miniontimestamp=time.time())
-      else:
-        record = record._replace(miniontimestamp=time.time())
-      write_record(conn, record)
-    conn.commit()
-  return 0
 
+def new_minion_and_check(conn, args):
+  with transaction(conn):
+    register_minions(conn, [args.instance])
+    return check(conn, args)
 
-def check(args):
-  lock = InterprocessLock("{0}.lock".format(args.database_file), args.lock_timeout)
-  if not lock.try_lock():
-    print "Could not take lock."
-    return 1
 
-  with contextlib.closing(lock), sqlite_connection(args.database_file) as conn:
-    create_table_if_not_exist(conn)
-    with sqlite_cursor(conn) as c:
-      c.execute("SELECT instanceid FROM instances"
-                " WHERE miniontimestamp IS NULL AND instancetimestamp IS NOT NULL")
-      for row in c:
-        print "Pending instance registered as minion, but not as EC2 instance: {0}".format(row[0])
-      c.execute("SELECT instanceid FROM instances"
-                " WHERE miniontimestamp IS NOT NULL"
-                " AND instancetimestamp IS NULL")
-      for row in c:
-        print "Pending instance registered as EC2 instance, but not as minion: {0}".format(row[0])
-
-      c.execute("SELECT COUNT(*) FROM instances "
-                "WHERE miniontimestamp IS NOT NULL"
-                " AND instancetimestamp IS NOT NULL AND instanceid=?",
-          (args.instance,))
-      found = c.fetchone()[0] > 0
+def check(conn, args):
+  # Collected and written at once since the pending list can be long.
+  lines = []
+  for row in conn.execute("SELECT instanceid FROM instances"
+                          " WHERE miniontimestamp IS NULL AND instancetimestamp IS NOT NULL"):
+    lines.append(f"Pending instance registered as minion, but not as EC2 instance: {row[0]}")
+  for row in conn.execute("SELECT instanceid FROM instances"
+                          " WHERE miniontimestamp IS NOT NULL"
+                          " AND instancetimestamp IS NULL"):
+    lines.append(f"Pending instance registered as EC2 instance, but not as minion: {row[0]}")
+
+  found = conn.execute("SELECT 1 FROM instances "
+                       "WHERE miniontimestamp IS NOT NULL"
+                       " AND instancetimestamp IS NOT NULL AND instanceid=? LIMIT 1",
+      (args.instance,)).fetchone() is not None
 
   if found:
-    print "The minion can be accepted."
-    return 0
+    lines.append("The minion can be accepted.")
+    status = 0
   else:
-    print "The minion is NOT ready for acceptance."
-    return 1
+    lines.append("The minion is NOT ready for acceptance.")
+    status = 1
+  sys.stdout.write("\n".join(lines) + "\n")
+  return status
 
 
-def purge(args):
-  lock = InterprocessLock("{0}.lock".format(args.database_file), args.lock_timeout)
-  if not lock.try_lock():
-    print "Could not take lock."
-    return 1
-
+def purge(conn, args):
   duration = datetime.timedelta(**{args.unit[0]: args.duration[0]}).total_seconds()
-  purge_older_than = time.time() - duration
+  purge_older_than = time.time_ns() - int(duration * 1e9)
+
+  with transaction(conn):
+    deleted = conn.execute("DELETE FROM instances"
+        " WHERE (miniontimestamp < ? or miniontimestamp IS NULL)"
+        " AND (instancetimestamp < ? or instancetimestamp IS NULL)",
+        (purge_older_than, purge_older_than,)).rowcount
+  print(f"Deleted {deleted} rows.")
+  # executescript() steps the pragma until done; execute() would only free a
+  # single page.
+  conn.executescript("PRAGMA incremental_vacuum")
+  conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+  # The daemon's connection is never closed cleanly, so re-analyze here
+  # rather than relying on sqlite_connection().
+  conn.execute("PRAGMA optimize")
+  return 0
 
-  with contextlib.closing(lock), sqlite_connection(args.database_file) as conn:
-    create_table_if_not_exist(conn)
-    with sqlite_cursor(conn) as c:
-      c.execute("DELETE FROM instances"
-          " WHERE (miniontimestamp < ? or miniontimestamp IS NULL)"
-          " AND (instancetimestamp < ? or instancetimestamp IS NULL)",
-          (purge_older_than, purge_older_than,))
-      print "Deleted", c.rowcount, "rows."
-      conn.commit()
-  
 
-def main(args):
+def build_parser():
   parser = argparse.ArgumentParser(description='A small database of minions to be accepted.')
   parser.add_argument('--database-file', default='autoscaling.db',
       help='sqlite3 database where where data is stored.')
   parser.add_argument('--lock-timeout', metavar='SECONDS', default=30, type=int,
-      help='number of seconds to wait for exclusive database lock')
+      help='number of seconds to wait for the database to be unlocked')
+  add_subcommands(parser)
+  return parser
+
 
-  subparsers = parser.add_subparsers(help='subcommand')
+def add_subcommands(parser):
+  subparsers = parser.add_subparsers(dest='command', required=True, help='subcommand')
 
   new_instance_parser = subparsers.add_parser('new-instance',
       help='register a new instance started')
@@ -242,9 +212,27 @@ def main(args):
   check_parser.add_argument('instance', metavar='INSTANCE',
       help='minion(s) to be added')
   check_parser.set_defaults(func=check)
-  
-  args = parser.parse_args()
-  return args.func(args)
+
+  new_instance_and_check_parser = subparsers.add_parser('new-instance-and-check',
+      help=('register a new instance started and check it in one go. Returns'
+      ' like check.'))
+  new_instance_and_check_parser.add_argument('instance', metavar='INSTANCE',
+      help='instance to be added')
+  new_instance_and_check_parser.set_defaults(func=new_instance_and_check)
+
+  new_minion_and_check_parser = subparsers.add_parser('new-minion-and-check',
+      help=('register a new minion registered and check it in one go. Returns'
+      ' like check.'))
+  new_minion_and_check_parser.add_argument('instance', metavar='MINION',
+      help='minion to be added')
+  new_minion_and_check_parser.set_defaults(func=new_minion_and_check)
+
+
+def main(args):
+  args = build_parser().parse_args()
+  with sqlite_connection(args.database_file, args.lock_timeout) as conn:
+    create_table_if_not_exist(conn)
+    return args.func(conn, args)
 
 
 if __name__=='__main__':
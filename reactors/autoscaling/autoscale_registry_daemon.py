@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""A long-lived server for the autoscale_registry.py commands.
+
+Starting a Python interpreter and opening the sqlite database for every
+reactor event costs far more than the actual queries. This daemon keeps a
+single database connection open and serves the same subcommands as
+autoscale_registry.py over a Unix socket.
+
+The protocol is one command per connection. The client sends a single
+newline-terminated line with the subcommand and its arguments separated by
+tabs, for example "check<TAB>myworker-i-12345678", and then shuts down its
+sending side. The daemon answers with a single byte; the ASCII digit of the
+exit code autoscale_registry.py would have returned. Anything but exactly one
+line of at most MAX_REQUEST_SIZE bytes is rejected, so arguments can never
+contain tabs or newlines.
+
+The daemon supports systemd socket activation. If no socket is handed over by
+systemd, it binds --socket itself.
+"""
+import argparse
+import contextlib
+import os
+import signal
+import socket
+import sys
+
+import autoscale_registry
+
+
+DEFAULT_DATABASE_LOCATION = '/var/tmp/salt-autoscaling.db'
+DEFAULT_SOCKET_LOCATION = '/var/run/salt-autoscaling.sock'
+
+# First file descriptor passed by systemd socket activation. See
+# sd_listen_fds(3).
+SD_LISTEN_FDS_START = 3
+
+# Seconds a client gets to send its command and receive the reply.
+CLIENT_TIMEOUT = 5
+
+# Maximum size in bytes of a request, including its newline.
+MAX_REQUEST_SIZE = 4096
+
+STATUS_INVALID_COMMAND = 2
+
+
+def systemd_socket():
+  """Returns the socket handed over by systemd, or None."""
+  if os.environ.get('LISTEN_PID') != str(os.getpid()):
+    return None
+  if os.environ.get('LISTEN_FDS') != '1':
+    return None
+  return socket.socket(fileno=SD_LISTEN_FDS_START)
+
+
+def socket_in_use(path):
+  probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  with contextlib.closing(probe):
+    try:
+      probe.connect(path)
+    except OSError:
+      return False
+  return True
+
+
+def bind_socket(path):
+  if socket_in_use(path):
+    sys.exit(f"Another daemon is already listening on {path}.")
+  if os.path.exists(path):
+    # Left behind by a daemon that did not exit cleanly.
+    os.unlink(path)
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  old_umask = os.umask(0o077)
+  try:
+    sock.bind(path)
+  finally:
+    os.umask(old_umask)
+  sock.listen(16)
+  return sock
+
+
+def read_request(client):
+  """Returns the request line sent by `client`, or None if it is malformed."""
+  data = b''
+  while len(data) <= MAX_REQUEST_SIZE:
+    chunk = client.recv(MAX_REQUEST_SIZE + 1 - len(data))
+    if not chunk:
+      break
+    data += chunk
+  if len(data) > MAX_REQUEST_SIZE or not data.endswith(b'\n') or data.count(b'\n') != 1:
+    return None
+  try:
+    return data[:-1].decode('utf-8')
+  except UnicodeDecodeError:
+    return None
+
+
+def build_command_parser():
+  """Returns a parser for client requests that only accepts subcommands."""
+  # The database options are fixed when the daemon starts.
+  parser = argparse.ArgumentParser(prog='autoscale_registry_daemon', add_help=False)
+  autoscale_registry.add_subcommands(parser)
+  return parser
+
+
+def handle_command(parser, conn, line):
+  try:
+    args = parser.parse_args(line.split('\t'))
+  except SystemExit:
+    # argparse has already written the usage error to stderr.
+    return STATUS_INVALID_COMMAND
+
+  try:
+    return args.func(conn, args)
+  except Exception as e:
+    print(f"Command failed: {line!r}: {e!r}", file=sys.stderr)
+    return 1
+
+
+def serve(server, conn):
+  parser = build_command_parser()
+  while True:
+    client, _ = server.accept()
+    with contextlib.closing(client):
+      # A misbehaving client must never take the daemon, and with it all
+      # reactor events, down.
+      try:
+        client.settimeout(CLIENT_TIMEOUT)
+        line = read_request(client)
+        if line is None:
+          print("Rejected malformed request.", file=sys.stderr)
+          status = STATUS_INVALID_COMMAND
+        else:
+          status = handle_command(parser, conn, line)
+        sys.stdout.flush()
+        client.sendall(str(status).encode())
+      except OSError as e:
+        # Includes timeouts. The client went away; nothing to reply to.
+        print(f"Client connection failed: {e}", file=sys.stderr)
+      except Exception as e:
+        print(f"Could not handle client: {e!r}", file=sys.stderr)
+
+
+def main(args):
+  parser = argparse.ArgumentParser(description='Serve the autoscaling registry over a Unix socket.')
+  parser.add_argument('--database-file', default=DEFAULT_DATABASE_LOCATION,
+      help='sqlite3 database where where data is stored.')
+  parser.add_argument('--lock-timeout', metavar='SECONDS', default=30, type=int,
+      help='number of seconds to wait for the database to be unlocked')
+  parser.add_argument('--socket', default=DEFAULT_SOCKET_LOCATION,
+      help='Unix socket to listen on unless passed one by systemd.')
+  args = parser.parse_args()
+
+  # Unwind normally on SIGTERM so the socket and database get cleaned up.
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+  server = systemd_socket()
+  bound_path = None
+  if server is None:
+    server = bind_socket(args.socket)
+    bound_path = args.socket
+  try:
+    with contextlib.closing(server), \
+        autoscale_registry.sqlite_connection(args.database_file, args.lock_timeout) as conn:
+      autoscale_registry.create_table_if_not_exist(conn)
+      serve(server, conn)
+  finally:
+    if bound_path is not None:
+      os.unlink(bound_path)
+
+
+if __name__=='__main__':
+  sys.exit(main(sys.argv))